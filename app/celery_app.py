@@ -12,4 +12,5 @@ celery_app = Celery(
 )
 celery_app.conf.task_routes = {
     "app.tasks.update_user_library_task": {"queue": "encoding"},
+    "app.tasks.backfill_embeddings_task": {"queue": "backfill"},
 }
@@ -0,0 +1,188 @@
+# app/embeddings.py
+import os
+from typing import Optional, List
+import numpy as np
+from sqlalchemy import text, Integer
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+from pgvector.sqlalchemy import Vector
+from .models import EmbeddingVersion, TrackEmbedding, Track, UserTasteProfile, user_tracks
+
+MODEL_NAME = os.environ.get("MODEL_NAME", "m-a-p/MERT-v1-330M")
+EMBEDDING_DIM = int(os.environ.get("EMBEDDING_DIM") or 1024)
+
+
+def vector_literal(vec) -> str:
+    """Build a pgvector text literal ('[x,y,...]') from any float sequence."""
+    return "[" + ",".join(f"{float(x):.6f}" for x in vec) + "]"
+
+
+def get_active_version(db: Session) -> Optional[EmbeddingVersion]:
+    """The embedding version currently served by similarity search (at most one)."""
+    return db.query(EmbeddingVersion).filter(EmbeddingVersion.is_active == True).first()
+
+
+def get_or_create_version(db: Session, model_name: str, dim: int) -> EmbeddingVersion:
+    version = db.query(EmbeddingVersion).filter(
+        EmbeddingVersion.model_name == model_name,
+        EmbeddingVersion.dim == dim
+    ).first()
+    if version is None:
+        version = EmbeddingVersion(model_name=model_name, dim=dim)
+        db.add(version)
+        db.commit()
+        db.refresh(version)
+    return version
+
+
+def save_track_embedding(db: Session, track: Track, version: EmbeddingVersion, vec) -> None:
+    """Store (or replace) a track's vector for the given version and mark the track encoded."""
+    values = list(map(float, vec))
+    if len(values) != version.dim:
+        raise ValueError(f"Expected {version.dim}-d embedding for {version.model_name}, got {len(values)}")
+    row = db.query(TrackEmbedding).filter(
+        TrackEmbedding.track_id == track.id,
+        TrackEmbedding.version_id == version.id
+    ).first()
+    if row is None:
+        row = TrackEmbedding(track_id=track.id, version_id=version.id)
+    row.embedding = values
+    track.encoded = True  # Mark track as encoded globally
+    db.add(row)
+    db.add(track)
+    db.commit()
+
+
+def version_coverage(db: Session, version: EmbeddingVersion) -> float:
+    """Fraction of encoded tracks that have a vector for this version."""
+    total = db.query(func.count(Track.id)).filter(Track.encoded == True).scalar() or 0
+    if total == 0:
+        return 0.0
+    covered = db.query(func.count(TrackEmbedding.track_id)).filter(
+        TrackEmbedding.version_id == version.id
+    ).scalar() or 0
+    return covered / total
+
+
+def vector_index_name(version: EmbeddingVersion) -> str:
+    return f"ix_track_embeddings_v{version.id}_hnsw"
+
+
+def build_version_index(db: Session, version: EmbeddingVersion) -> None:
+    """
+    Build the HNSW cosine index for one version. track_embeddings mixes dimensions,
+    so each version gets a partial expression index casting to its fixed dim;
+    queries must use the same `embedding::vector(dim)` expression to hit it.
+    """
+    db.execute(text("SET LOCAL maintenance_work_mem = '1GB'"))
+    db.execute(text(
+        f"CREATE INDEX IF NOT EXISTS {vector_index_name(version)} ON track_embeddings "
+        f"USING hnsw ((embedding::vector({int(version.dim)})) vector_cosine_ops) "
+        f"WHERE version_id = {int(version.id)}"
+    ))
+    db.commit()
+
+
+def activate_version(db: Session, version: EmbeddingVersion) -> None:
+    """Atomically switch similarity search to `version` (single transaction)."""
+    db.query(EmbeddingVersion).filter(
+        EmbeddingVersion.is_active == True,
+        EmbeddingVersion.id != version.id
+    ).update({EmbeddingVersion.is_active: False}, synchronize_session=False)
+    version.is_active = True
+    version.backfill_status = "active"
+    version.activated_at = func.now()
+    db.add(version)
+    db.commit()
+
+
+def ensure_default_version(db: Session) -> EmbeddingVersion:
+    """
+    First-run migration: register MODEL_NAME/EMBEDDING_DIM as the active version and
+    copy any legacy single-model vectors from tracks.embedding into track_embeddings.
+    Keyed on there being an active version, not any version: a backfill target registered
+    before the migration ran must not stop the default from being activated.
+    """
+    active = get_active_version(db)
+    if active is not None:
+        return active
+    version = get_or_create_version(db, MODEL_NAME, EMBEDDING_DIM)
+    db.execute(text("""
+        INSERT INTO track_embeddings (track_id, version_id, embedding)
+        SELECT id, :version_id, embedding FROM tracks
+        WHERE embedding IS NOT NULL AND encoded = TRUE AND vector_dims(embedding) = :dim
+        ON CONFLICT DO NOTHING
+    """), {"version_id": version.id, "dim": version.dim})
+    db.commit()
+    build_version_index(db, version)
+    activate_version(db, version)
+    return version
+
+
+def update_taste_profile(db: Session, user_id: int, version: EmbeddingVersion, vectors: List) -> None:
+    """
+    Fold newly linked/encoded track vectors into the user's running-mean taste centroid.
+    Call after the tracks are linked to the user and their vectors are committed.
+    """
+    if not vectors:
+        return
+    new = np.asarray(vectors, dtype=np.float64)
+    profile = db.query(UserTasteProfile).filter(
+        UserTasteProfile.user_id == user_id,
+        UserTasteProfile.version_id == version.id
+    ).first()
+    if profile is None:
+        # No running mean yet: seed it from everything already linked (includes `vectors`)
+        rebuild_taste_profile(db, user_id, version)
+        db.commit()
+        return
+    total = np.asarray(profile.centroid, dtype=np.float64) * profile.track_count + new.sum(axis=0)
+    profile.track_count += new.shape[0]
+    profile.centroid = (total / profile.track_count).tolist()
+    db.add(profile)
+    db.commit()
+
+
+def sync_taste_profile(db: Session, user_id: int, version: EmbeddingVersion) -> None:
+    """
+    Rebuild the centroid when it no longer counts every linked track with a vector in `version`.
+    Tracks linked before they had a vector get it from another user's sync or the backfill,
+    and never pass through this user's incremental folds.
+    """
+    linked = db.query(func.count(TrackEmbedding.track_id)).join(
+        user_tracks, user_tracks.c.track_id == TrackEmbedding.track_id
+    ).filter(
+        user_tracks.c.user_id == user_id,
+        TrackEmbedding.version_id == version.id
+    ).scalar() or 0
+    profile = db.query(UserTasteProfile).filter(
+        UserTasteProfile.user_id == user_id,
+        UserTasteProfile.version_id == version.id
+    ).first()
+    if linked != (profile.track_count if profile else 0):
+        rebuild_taste_profile(db, user_id, version)
+        db.commit()
+
+
+def rebuild_taste_profile(db: Session, user_id: int, version: EmbeddingVersion) -> Optional[UserTasteProfile]:
+    """
+    Recompute a user's centroid from scratch (profiles predating a version or this feature).
+    Only flushes, so it can run inside a budgeted request; the caller commits.
+    """
+    row = db.execute(text(f"""
+        SELECT AVG(te.embedding::vector({int(version.dim)})) AS centroid, COUNT(*) AS n
+        FROM user_tracks ut
+        JOIN track_embeddings te ON te.track_id = ut.track_id AND te.version_id = :version_id
+        WHERE ut.user_id = :user_id
+    """).columns(centroid=Vector(), n=Integer), {"user_id": user_id, "version_id": version.id}).first()
+    if row is None or not row.n:
+        return None
+    profile = db.query(UserTasteProfile).filter(
+        UserTasteProfile.user_id == user_id,
+        UserTasteProfile.version_id == version.id
+    ).first() or UserTasteProfile(user_id=user_id, version_id=version.id)
+    profile.centroid = list(map(float, row.centroid))
+    profile.track_count = int(row.n)
+    db.add(profile)
+    db.flush()
+    return profile
@@ -1,15 +1,23 @@
 # app/main.py
 import os
 import json
+from typing import List, Optional
 from fastapi import FastAPI, Request, Depends, HTTPException, Query
 from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from spotipy import oauth2
 from spotipy.oauth2 import SpotifyOAuth
 import uuid
+import time
+from sqlalchemy.exc import OperationalError
 from .db import SessionLocal, init_db
 from .models import User, Track
-from .tasks import update_user_library_task, generate_playlist_task
+from .tasks import update_user_library_task, generate_playlist_task, mark_live_sync_queued
+from .recommenders import (
+    get_similar_tracks, get_diverse_recommendations, cache_recommendations, get_cached_recommendations,
+    RecommendationTimeout
+)
+from .embeddings import get_active_version
 import redis
 import threading
 
@@ -24,6 +32,9 @@ def startup():
 REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
 r = redis.Redis.from_url(REDIS_URL, decode_responses=True)
 
+# Latency budget for the synchronous recommendations endpoint
+RECOMMENDATIONS_BUDGET_MS = int(os.environ.get("RECOMMENDATIONS_BUDGET_MS", "250"))
+
 SPOTIFY_CLIENT_ID = os.environ.get("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.environ.get("SPOTIFY_CLIENT_SECRET")
 SPOTIFY_REDIRECT_URI = os.environ.get("SPOTIFY_REDIRECT_URI", "http://localhost:8000/auth/callback")
@@ -87,7 +98,8 @@ def start_update_library(user_id: int, db = Depends(get_db)):
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    # start background task
+    # start background task (counted so the re-embedding backfill backs off while it runs)
+    mark_live_sync_queued()
     task = update_user_library_task.delay(user.refresh_token, user.id)
     return {"task_id": task.id}
 
@@ -165,9 +177,83 @@ def search_tracks(q: str = Query("", min_length=1), limit: int = Query(10, ge=1,
     return [{"id": t.id, "spotify_track_id": t.spotify_track_id, "name": t.name, "artist": t.artist} for t in tracks]
 
 
+@app.get("/api/recommendations/{seed_track_id}")
+def get_recommendations(
+    seed_track_id: int,
+    limit: int = Query(10, ge=1, le=50),
+    scope: str = "global",
+    user_id: Optional[int] = None,
+    db = Depends(get_db)
+):
+    """
+    Return the seed's nearest neighbors inline, from the whole catalog or (scope=library&user_id=...)
+    only the user's saved tracks. The query runs under RECOMMENDATIONS_BUDGET_MS; if it overruns
+    (or the DB errors) the last cached result for the seed and active version is served instead.
+    """
+    if scope not in ("global", "library"):
+        raise HTTPException(status_code=400, detail="scope must be 'global' or 'library'")
+    if scope == "library" and user_id is None:
+        raise HTTPException(status_code=400, detail="scope=library requires user_id")
+    library_user_id = user_id if scope == "library" else None
+    started = time.perf_counter()
+    # Resolved up front so the cache fallback is keyed by the version being served
+    version = get_active_version(db)
+    if version is None:
+        raise HTTPException(status_code=404, detail="No active embedding version")
+    try:
+        tracks = get_similar_tracks(db, seed_track_id=seed_track_id, limit=limit, timeout_ms=RECOMMENDATIONS_BUDGET_MS,
+                                    scope=scope, user_id=library_user_id, version=version)
+        db.commit()  # end the transaction so SET LOCAL statement_timeout doesn't linger
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except (OperationalError, RecommendationTimeout) as e:
+        db.rollback()
+        print(f"Recommendations for {seed_track_id} exceeded budget or failed: {e}")
+        tracks = get_cached_recommendations(r, version.id, seed_track_id, limit, library_user_id)
+        if tracks is None:
+            raise HTTPException(status_code=503, detail="Recommendations temporarily unavailable")
+        return {"seed_track_id": seed_track_id, "scope": scope, "tracks": tracks, "cached": True,
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+    cache_recommendations(r, version.id, seed_track_id, limit, tracks, library_user_id)
+    return {"seed_track_id": seed_track_id, "scope": scope, "tracks": tracks, "cached": False,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+
+@app.get("/api/recommendations")
+def get_mixed_recommendations(
+    seed_track_ids: Optional[List[int]] = Query(None),
+    user_id: Optional[int] = None,
+    limit: int = Query(10, ge=1, le=50),
+    diversity: float = Query(0.3, ge=0.0, le=1.0),
+    artist_cap: int = Query(2, ge=1, le=50),
+    db = Depends(get_db)
+):
+    """
+    Diverse recommendations from several seeds (?seed_track_ids=1&seed_track_ids=2) or, with only
+    user_id, from the user's taste profile. diversity is the MMR novelty weight (0 = nearest neighbors).
+    """
+    if not seed_track_ids and user_id is None:
+        raise HTTPException(status_code=400, detail="Provide seed_track_ids or user_id")
+    started = time.perf_counter()
+    try:
+        tracks = get_diverse_recommendations(db, seed_track_ids=seed_track_ids, user_id=user_id, limit=limit,
+                                             lambda_=1.0 - diversity, artist_cap=artist_cap,
+                                             timeout_ms=RECOMMENDATIONS_BUDGET_MS)
+        db.commit()
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except (OperationalError, RecommendationTimeout) as e:
+        db.rollback()
+        print(f"Diverse recommendations exceeded budget or failed: {e}")
+        raise HTTPException(status_code=503, detail="Recommendations temporarily unavailable")
+    return {"seed_track_ids": seed_track_ids or [], "user_id": user_id, "tracks": tracks,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+
 @app.post("/api/generate_playlist")
 def start_generate_playlist(user_id: int, seed_track_id: int, db = Depends(get_db)):
-    """Queue a playlist generation task and return task_id."""
+    """Queue a playlist generation task (reuses recommendations already computed for the seed) and return task_id."""
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
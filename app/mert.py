@@ -4,7 +4,8 @@ import torch
 import numpy as np
 from transformers import AutoModel, AutoFeatureExtractor
 
-MODEL_NAME = os.environ.get("MODEL_NAME", "m-a-p/MERT-v1-330M")
+from .embeddings import MODEL_NAME
+
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
 class MERTEmbedder:
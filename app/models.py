@@ -1,5 +1,5 @@
 # app/models.py
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean, Table
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean, Table, UniqueConstraint, Index, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
@@ -37,9 +37,53 @@ class Track(Base):
     artist = Column(String)
     preview_url = Column(String, nullable=True)
     encoded = Column(Boolean, default=False)  # Track encoding status (global, not per user)
-    # store 1024-d embeddings
+    # legacy single-model 1024-d embeddings; vectors now live in track_embeddings per version
     embedding = Column(Vector(1024), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     # Many-to-many relationship with users
     users = relationship("User", secondary=user_tracks, back_populates="tracks")
+
+
+class EmbeddingVersion(Base):
+    """An embedding space (model + dimension). Exactly one version is active for search."""
+    __tablename__ = "embedding_versions"
+    id = Column(Integer, primary_key=True, index=True)
+    model_name = Column(String, nullable=False)
+    dim = Column(Integer, nullable=False)
+    is_active = Column(Boolean, default=False, nullable=False)
+    # backfill checkpoint: highest tracks.id processed so far
+    backfill_cursor = Column(Integer, default=0, nullable=False)
+    backfill_status = Column(String, default="pending")  # pending | running | incomplete | active
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    activated_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("model_name", "dim", name="uq_embedding_versions_model_dim"),
+        Index("uq_embedding_versions_active", "is_active", unique=True, postgresql_where=text("is_active")),
+    )
+
+class TrackEmbedding(Base):
+    __tablename__ = "track_embeddings"
+    track_id = Column(Integer, ForeignKey("tracks.id"), primary_key=True)
+    version_id = Column(Integer, ForeignKey("embedding_versions.id"), primary_key=True, index=True)
+    # dimension depends on the version; each version gets its own partial HNSW index
+    embedding = Column(Vector(), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class UserTasteProfile(Base):
+    """Running mean of a user's library vectors in one embedding version."""
+    __tablename__ = "user_taste_profiles"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    version_id = Column(Integer, ForeignKey("embedding_versions.id"), primary_key=True)
+    centroid = Column(Vector(), nullable=False)
+    track_count = Column(Integer, default=0, nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class PreviewCache(Base):
+    """Resolved preview URL per Spotify track; a NULL preview_url is a cached "no preview" result."""
+    __tablename__ = "preview_cache"
+    spotify_track_id = Column(String, primary_key=True)
+    preview_url = Column(String, nullable=True)
+    resolved_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime(timezone=True), nullable=False)
@@ -0,0 +1,49 @@
+# app/previews.py
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert
+from .models import PreviewCache
+
+# Found previews are stable for a long time; misses are retried sooner in case one appears
+PREVIEW_CACHE_TTL_DAYS = int(os.environ.get("PREVIEW_CACHE_TTL_DAYS", "30"))
+PREVIEW_NEGATIVE_TTL_DAYS = int(os.environ.get("PREVIEW_NEGATIVE_TTL_DAYS", "7"))
+
+
+def lookup_cached_previews(db: Session, spotify_track_ids: List[str]) -> Dict[str, Optional[str]]:
+    """
+    Bulk lookup of unexpired cache entries. Returns {spotify_track_id: preview_url or None};
+    ids missing from the result have never been resolved (or their entry expired).
+    """
+    if not spotify_track_ids:
+        return {}
+    rows = db.query(PreviewCache.spotify_track_id, PreviewCache.preview_url).filter(
+        PreviewCache.spotify_track_id.in_(spotify_track_ids),
+        PreviewCache.expires_at > datetime.now(timezone.utc)
+    ).all()
+    return {row[0]: row[1] for row in rows}
+
+
+def store_preview_results(db: Session, results: Dict[str, Optional[str]]) -> None:
+    """Upsert resolver output; None values are stored as negative results with the shorter TTL."""
+    if not results:
+        return
+    now = datetime.now(timezone.utc)
+    rows = [{
+        "spotify_track_id": spotify_track_id,
+        "preview_url": preview_url,
+        "resolved_at": now,
+        "expires_at": now + timedelta(days=PREVIEW_CACHE_TTL_DAYS if preview_url else PREVIEW_NEGATIVE_TTL_DAYS),
+    } for spotify_track_id, preview_url in results.items()]
+    stmt = insert(PreviewCache).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[PreviewCache.spotify_track_id],
+        set_={
+            "preview_url": stmt.excluded.preview_url,
+            "resolved_at": stmt.excluded.resolved_at,
+            "expires_at": stmt.excluded.expires_at,
+        }
+    )
+    db.execute(stmt)
+    db.commit()
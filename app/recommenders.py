@@ -1,38 +1,116 @@
 # app/recommenders.py
-from typing import List, Dict
+import re
+import json
+import time
+from typing import List, Dict, Optional
+import numpy as np
 from sqlalchemy.orm import Session
-from sqlalchemy import text
-from .models import Track
+from sqlalchemy import text, Integer, String, Float
+from pgvector.sqlalchemy import Vector
+from .models import TrackEmbedding, UserTasteProfile, EmbeddingVersion
+from .embeddings import get_active_version, vector_literal, rebuild_taste_profile, vector_index_name
 
 
-def get_similar_tracks(db: Session, seed_track_id: int, limit: int = 10) -> List[Dict]:
+RECOMMENDATIONS_CACHE_TTL = 24 * 3600
+
+# Diversity re-ranking defaults
+MMR_LAMBDA = 0.7        # 1.0 = pure relevance, 0.0 = pure novelty
+MMR_OVERSAMPLE = 5      # candidates fetched per returned track
+MMR_ARTIST_CAP = 2      # max tracks per primary artist
+
+# Library-scoped search: brute force up to this many vectors, iterative HNSW scan beyond
+LIBRARY_EXACT_MAX = 20000
+# Iterative scan visits ~limit / selectivity tuples to find `limit` library rows; budget this
+# many times that for hnsw.max_scan_tuples, and brute force when that exceeds the library
+LIBRARY_SCAN_HEADROOM = 4
+
+# pgvector version check result, cached per process (see _iterative_scan_supported)
+_ITERATIVE_SCAN_SUPPORTED: Optional[bool] = None
+
+
+class RecommendationTimeout(Exception):
+    """Raised when a recommendation request runs out of its latency budget between statements."""
+
+
+class _QueryBudget:
+    """
+    One latency budget for a whole recommendation request. statement_timeout only caps a
+    single statement, so before each statement the remaining time is re-applied as the
+    timeout (or RecommendationTimeout is raised once nothing is left).
     """
-    Return top-N similar tracks across the entire tracks table using pgvector cosine distance.
-    Requires that the seed track has a non-null embedding.
+    def __init__(self, db: Session, timeout_ms: Optional[int]):
+        self.db = db
+        self.deadline = None if timeout_ms is None else time.perf_counter() + timeout_ms / 1000.0
+
+    def __call__(self) -> None:
+        if self.deadline is None:
+            return
+        remaining_ms = int((self.deadline - time.perf_counter()) * 1000)
+        if remaining_ms <= 0:
+            raise RecommendationTimeout("Recommendation latency budget exceeded")
+        self.db.execute(text(f"SET LOCAL statement_timeout = {remaining_ms}"))
+
+
+def get_similar_tracks(db: Session, seed_track_id: int, limit: int = 10, timeout_ms: Optional[int] = None,
+                       scope: str = "global", user_id: Optional[int] = None,
+                       version: Optional[EmbeddingVersion] = None) -> List[Dict]:
+    """
+    Return top-N similar tracks using pgvector cosine distance, across the entire catalog
+    (scope="global") or only the given user's saved tracks (scope="library").
+    Searches the given (default: active) embedding version; requires that the seed track
+    has a vector in it. With timeout_ms, all statements together must finish within the
+    budget (raises RecommendationTimeout, or sqlalchemy OperationalError from
+    statement_timeout, when exceeded).
     """
+    if scope not in ("global", "library"):
+        raise ValueError(f"Unknown scope '{scope}'")
+    if scope == "library" and user_id is None:
+        raise ValueError("scope=library requires a user")
+    budget = _QueryBudget(db, timeout_ms)
+
+    if version is None:
+        budget()
+        version = get_active_version(db)
+    if version is None:
+        raise ValueError("No active embedding version")
+
     # Fetch seed embedding using ORM so we get a proper pgvector-backed value
-    seed_track = db.query(Track).filter(Track.id == seed_track_id, Track.embedding != None).first()
-    if seed_track is None:
+    budget()
+    seed = db.query(TrackEmbedding).filter(
+        TrackEmbedding.track_id == seed_track_id,
+        TrackEmbedding.version_id == version.id
+    ).first()
+    if seed is None:
         raise ValueError("No embedding found for the selected track")
 
-    seed_vec = list(seed_track.embedding)
     # Build pgvector literal and cast explicitly to vector to avoid ARRAY[text] binding
-    vec_str = "[" + ",".join(f"{float(x):.6f}" for x in seed_vec) + "]"
+    vec_str = vector_literal(seed.embedding)
+    dim = int(version.dim)
 
-    # Order by cosine distance using pgvector operator <=>, filter encoded tracks only
-    # Embed the vector literal directly to avoid driver/paramstyle casting issues
-    sql = f"""
-        SELECT t.id, t.spotify_track_id, t.name, t.artist,
-               t.embedding <=> '{vec_str}'::vector AS distance
-        FROM tracks t
-        WHERE t.embedding IS NOT NULL AND t.encoded = TRUE AND t.id != :seed_id
-        ORDER BY distance
-        LIMIT :limit
-    """
-    rows = db.execute(
-        text(sql),
-        {"seed_id": seed_track_id, "limit": limit}
-    ).fetchall()
+    if scope == "library":
+        rows = _library_neighbors(db, version, vec_str, seed_track_id, user_id, limit, budget)
+    else:
+        # HNSW only yields ef_search rows per scan; make sure it covers the LIMIT
+        if limit > 40:
+            db.execute(text(f"SET LOCAL hnsw.ef_search = {int(limit)}"))
+        # Order by cosine distance using pgvector operator <=>, restricted to the active version.
+        # The embedding::vector(dim) expression and version_id predicate match the per-version
+        # partial HNSW index (see embeddings.build_version_index).
+        # Embed the vector literal directly to avoid driver/paramstyle casting issues
+        sql = f"""
+            SELECT t.id, t.spotify_track_id, t.name, t.artist,
+                   (te.embedding::vector({dim})) <=> '{vec_str}'::vector({dim}) AS distance
+            FROM track_embeddings te
+            JOIN tracks t ON t.id = te.track_id
+            WHERE te.version_id = {int(version.id)} AND te.track_id != :seed_id
+            ORDER BY distance
+            LIMIT :limit
+        """
+        budget()
+        rows = db.execute(
+            text(sql),
+            {"seed_id": seed_track_id, "limit": limit}
+        ).fetchall()
 
     results: List[Dict] = []
     for row in rows:
@@ -46,3 +124,278 @@ def get_similar_tracks(db: Session, seed_track_id: int, limit: int = 10) -> List
     return results
 
 
+def _iterative_scan_supported(db: Session) -> bool:
+    """
+    Whether the installed pgvector (0.8+) has hnsw.iterative_scan. Checked from pg_extension
+    rather than by trying the SET: PostgreSQL < 15 silently accepts unknown hnsw.* settings
+    as placeholders, which would leave the scan non-iterative without any error.
+    """
+    global _ITERATIVE_SCAN_SUPPORTED
+    if _ITERATIVE_SCAN_SUPPORTED is None:
+        extversion = db.execute(text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")).scalar()
+        parts = [int(p) for p in re.findall(r"\d+", extversion or "")[:2]]
+        _ITERATIVE_SCAN_SUPPORTED = len(parts) == 2 and tuple(parts) >= (0, 8)
+    return _ITERATIVE_SCAN_SUPPORTED
+
+
+def _library_neighbors(db: Session, version, vec_str: str, seed_track_id: int, user_id: int, limit: int,
+                       budget: _QueryBudget):
+    """
+    Nearest neighbors among one user's saved tracks.
+    Filtering the global HNSW scan by user_tracks would drop results (the index only
+    yields ef_search candidates before the filter), so:
+    - small libraries are brute-forced: the MATERIALIZED CTE keeps the planner off the
+      index and ranks every library vector, which is exact;
+    - large libraries use pgvector's iterative index scan (0.8+), which keeps walking the
+      graph until enough rows pass the filter; relaxed_order output is re-sorted outside.
+      The scan stops at hnsw.max_scan_tuples, so that is sized from the library's share of
+      the version (selectivity); when the scan would cost more than brute force, or still
+      comes back short of `limit`, the exact scan is used.
+      Older pgvector has no iterative scan, so those fall back to the exact scan.
+    """
+    dim = int(version.dim)
+    params = {"seed_id": seed_track_id, "user_id": user_id, "limit": limit}
+    budget()
+    size = db.execute(text("""
+        SELECT COUNT(*) FROM user_tracks ut
+        JOIN track_embeddings te ON te.track_id = ut.track_id AND te.version_id = :version_id
+        WHERE ut.user_id = :user_id
+    """), {"version_id": version.id, "user_id": user_id}).scalar() or 0
+
+    exact_sql = f"""
+        WITH lib AS MATERIALIZED (
+            SELECT te.track_id, te.embedding::vector({dim}) AS embedding
+            FROM user_tracks ut
+            JOIN track_embeddings te ON te.track_id = ut.track_id AND te.version_id = {int(version.id)}
+            WHERE ut.user_id = :user_id AND ut.track_id != :seed_id
+        )
+        SELECT t.id, t.spotify_track_id, t.name, t.artist,
+               lib.embedding <=> '{vec_str}'::vector({dim}) AS distance
+        FROM lib
+        JOIN tracks t ON t.id = lib.track_id
+        ORDER BY distance
+        LIMIT :limit
+    """
+    if size <= LIBRARY_EXACT_MAX or not _iterative_scan_supported(db):
+        budget()
+        return db.execute(text(exact_sql), params).fetchall()
+
+    # Version size from the partial index's stats (a COUNT over a large catalog costs more
+    # than the search); no stats means no usable index either
+    budget()
+    indexed = db.execute(
+        text("SELECT reltuples FROM pg_class WHERE relname = :name"), {"name": vector_index_name(version)}
+    ).scalar() or 0
+    scan_tuples = int(LIBRARY_SCAN_HEADROOM * limit * max(float(indexed), size) / size)
+    if indexed <= 0 or scan_tuples > size:
+        budget()
+        return db.execute(text(exact_sql), params).fetchall()
+
+    iterative_sql = f"""
+        WITH nn AS MATERIALIZED (
+            SELECT te.track_id, (te.embedding::vector({dim})) <=> '{vec_str}'::vector({dim}) AS distance
+            FROM track_embeddings te
+            WHERE te.version_id = {int(version.id)} AND te.track_id != :seed_id
+              AND EXISTS (SELECT 1 FROM user_tracks ut WHERE ut.track_id = te.track_id AND ut.user_id = :user_id)
+            ORDER BY distance
+            LIMIT :limit
+        )
+        SELECT t.id, t.spotify_track_id, t.name, t.artist, nn.distance
+        FROM nn
+        JOIN tracks t ON t.id = nn.track_id
+        ORDER BY nn.distance
+    """
+    db.execute(text("SET LOCAL hnsw.iterative_scan = 'relaxed_order'"))
+    db.execute(text(f"SET LOCAL hnsw.ef_search = {max(100, 4 * int(limit))}"))
+    db.execute(text(f"SET LOCAL hnsw.max_scan_tuples = {max(20000, scan_tuples)}"))
+    budget()
+    rows = db.execute(text(iterative_sql), params).fetchall()
+    if len(rows) < limit:
+        # the scan budget ran out before enough library rows turned up
+        budget()
+        rows = db.execute(text(exact_sql), params).fetchall()
+    return rows
+
+
+def _recommendations_cache_key(version_id: int, seed_track_id: int, limit: int,
+                               library_user_id: Optional[int] = None) -> str:
+    # keyed by embedding version so a model switch never serves the old model's neighbors
+    if library_user_id is not None:
+        return f"recs-v{version_id}-{seed_track_id}-{limit}-library-{library_user_id}"
+    return f"recs-v{version_id}-{seed_track_id}-{limit}"
+
+
+def cache_recommendations(r, version_id: int, seed_track_id: int, limit: int, tracks: List[Dict],
+                          library_user_id: Optional[int] = None) -> None:
+    """Remember the last computed neighbors for a seed (latency fallback + playlist reuse)."""
+    try:
+        r.set(_recommendations_cache_key(version_id, seed_track_id, limit, library_user_id), json.dumps(tracks),
+              ex=RECOMMENDATIONS_CACHE_TTL)
+    except Exception as e:
+        print(f"Error caching recommendations: {e}")
+
+
+def get_cached_recommendations(r, version_id: int, seed_track_id: int, limit: int,
+                               library_user_id: Optional[int] = None) -> Optional[List[Dict]]:
+    try:
+        cached = r.get(_recommendations_cache_key(version_id, seed_track_id, limit, library_user_id))
+    except Exception as e:
+        print(f"Error reading cached recommendations: {e}")
+        return None
+    return json.loads(cached) if cached else None
+
+
+def mmr_rerank(query: np.ndarray, candidates: np.ndarray, artists: List[str], k: int,
+               lambda_: float = MMR_LAMBDA, artist_cap: Optional[int] = MMR_ARTIST_CAP) -> List[int]:
+    """
+    Greedy maximal-marginal-relevance selection over unit-normalised candidate vectors.
+    Each step scores every remaining candidate at once as
+    lambda * sim(query) - (1 - lambda) * max sim(already selected), keeping a running
+    max so the whole pass is O(k * n * d). Candidates whose primary artist already has
+    `artist_cap` picks are masked out. Returns indices into `candidates` in pick order.
+    """
+    n = candidates.shape[0]
+    if n == 0 or k <= 0:
+        return []
+    norms = np.linalg.norm(candidates, axis=1, keepdims=True)
+    cands = candidates / np.where(norms > 0, norms, 1.0)
+    q = query / (np.linalg.norm(query) or 1.0)
+
+    relevance = cands @ q
+    redundancy = np.zeros(n)
+    available = np.ones(n, dtype=bool)
+    # "Artist A, Artist B" -> "artist a"; same primary artist counts against one cap
+    _, artist_codes = np.unique([a.split(",")[0].strip().lower() for a in artists], return_inverse=True)
+    artist_counts = np.zeros(artist_codes.max() + 1, dtype=int)
+
+    selected: List[int] = []
+    while len(selected) < k and available.any():
+        scores = np.where(available, lambda_ * relevance - (1 - lambda_) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, cands @ cands[best])
+        artist_counts[artist_codes[best]] += 1
+        if artist_cap is not None and artist_counts[artist_codes[best]] >= artist_cap:
+            available &= artist_codes != artist_codes[best]
+    return selected
+
+
+def _fetch_candidates(db: Session, version, query_vec, limit: int, exclude_ids: List[int],
+                      budget: _QueryBudget, exclude_user_id: Optional[int] = None):
+    """
+    One ANN query for `limit` nearest tracks, returning their vectors alongside metadata.
+    With exclude_user_id the user's own library is filtered out. A taste centroid sits
+    inside that library, so a plain post-filtered HNSW scan would discard most of its
+    rows; pgvector 0.8+ uses an iterative scan (re-sorted outside a MATERIALIZED CTE),
+    older versions over-fetch up to the ef_search maximum and filter in Python.
+    """
+    dim = int(version.dim)
+    vec_str = vector_literal(query_vec)
+    columns = dict(id=Integer, spotify_track_id=String, name=String, artist=String,
+                   distance=Float, embedding=Vector())
+    params = {"exclude_ids": list(exclude_ids), "user_id": exclude_user_id, "limit": limit}
+    plain_sql = f"""
+        SELECT t.id, t.spotify_track_id, t.name, t.artist,
+               (te.embedding::vector({dim})) <=> '{vec_str}'::vector({dim}) AS distance,
+               te.embedding AS embedding
+        FROM track_embeddings te
+        JOIN tracks t ON t.id = te.track_id
+        WHERE te.version_id = {int(version.id)} AND NOT (te.track_id = ANY(:exclude_ids))
+        ORDER BY distance
+        LIMIT :limit
+    """
+
+    if exclude_user_id is None:
+        # HNSW only yields ef_search rows per scan; raise it so the oversampled LIMIT is honoured
+        db.execute(text(f"SET LOCAL hnsw.ef_search = {max(40, int(limit))}"))
+        budget()
+        return db.execute(text(plain_sql).columns(**columns), params).fetchall()
+
+    if _iterative_scan_supported(db):
+        sql = f"""
+            WITH nn AS MATERIALIZED (
+                SELECT te.track_id, te.embedding,
+                       (te.embedding::vector({dim})) <=> '{vec_str}'::vector({dim}) AS distance
+                FROM track_embeddings te
+                WHERE te.version_id = {int(version.id)} AND NOT (te.track_id = ANY(:exclude_ids))
+                  AND NOT EXISTS (SELECT 1 FROM user_tracks ut WHERE ut.track_id = te.track_id AND ut.user_id = :user_id)
+                ORDER BY distance
+                LIMIT :limit
+            )
+            SELECT t.id, t.spotify_track_id, t.name, t.artist, nn.distance, nn.embedding
+            FROM nn
+            JOIN tracks t ON t.id = nn.track_id
+            ORDER BY nn.distance
+        """
+        db.execute(text("SET LOCAL hnsw.iterative_scan = 'relaxed_order'"))
+        db.execute(text(f"SET LOCAL hnsw.ef_search = {max(100, int(limit))}"))
+        budget()
+        return db.execute(text(sql).columns(**columns), params).fetchall()
+
+    fetch_limit = min(1000, int(limit) * 20)  # 1000 is pgvector's ef_search ceiling
+    db.execute(text(f"SET LOCAL hnsw.ef_search = {max(40, fetch_limit)}"))
+    budget()
+    rows = db.execute(text(plain_sql).columns(**columns), {**params, "limit": fetch_limit}).fetchall()
+    if not rows:
+        return rows
+    budget()
+    owned = {row[0] for row in db.execute(
+        text("SELECT track_id FROM user_tracks WHERE user_id = :user_id AND track_id = ANY(:ids)"),
+        {"user_id": exclude_user_id, "ids": [row.id for row in rows]}
+    ).fetchall()}
+    return [row for row in rows if row.id not in owned][:limit]
+
+
+def get_diverse_recommendations(db: Session, seed_track_ids: Optional[List[int]] = None, user_id: Optional[int] = None,
+                                limit: int = 10, lambda_: float = MMR_LAMBDA, artist_cap: Optional[int] = MMR_ARTIST_CAP,
+                                timeout_ms: Optional[int] = None) -> List[Dict]:
+    """
+    Recommend from several seed tracks (their mean vector) or, without seeds, from the
+    user's taste centroid (excluding tracks already in their library). Fetches
+    limit * MMR_OVERSAMPLE candidates in a single ANN query, then MMR re-ranks them
+    with a per-artist cap. timeout_ms budgets the whole request, as in get_similar_tracks.
+    """
+    budget = _QueryBudget(db, timeout_ms)
+
+    budget()
+    version = get_active_version(db)
+    if version is None:
+        raise ValueError("No active embedding version")
+
+    exclude_user_id = None
+    budget()
+    if seed_track_ids:
+        seeds = db.query(TrackEmbedding.embedding).filter(
+            TrackEmbedding.version_id == version.id,
+            TrackEmbedding.track_id.in_(seed_track_ids)
+        ).all()
+        if not seeds:
+            raise ValueError("No embeddings found for the selected tracks")
+        query_vec = np.mean([np.asarray(row[0], dtype=np.float64) for row in seeds], axis=0)
+    elif user_id is not None:
+        profile = db.query(UserTasteProfile).filter(
+            UserTasteProfile.user_id == user_id,
+            UserTasteProfile.version_id == version.id
+        ).first() or rebuild_taste_profile(db, user_id, version)
+        if profile is None:
+            raise ValueError("No encoded tracks in this user's library yet")
+        query_vec = np.asarray(profile.centroid, dtype=np.float64)
+        exclude_user_id = user_id
+    else:
+        raise ValueError("Provide seed tracks or a user")
+
+    rows = _fetch_candidates(db, version, query_vec, limit * MMR_OVERSAMPLE,
+                             exclude_ids=seed_track_ids or [], budget=budget, exclude_user_id=exclude_user_id)
+    if not rows:
+        return []
+    candidates = np.asarray([row.embedding for row in rows], dtype=np.float64)
+    picks = mmr_rerank(query_vec, candidates, [row.artist or "" for row in rows], limit,
+                       lambda_=lambda_, artist_cap=artist_cap)
+    return [{
+        "id": rows[i].id,
+        "spotify_track_id": rows[i].spotify_track_id,
+        "name": rows[i].name,
+        "artist": rows[i].artist,
+        "distance": float(rows[i].distance),
+    } for i in picks]
@@ -0,0 +1,40 @@
+# app/scripts/backfill_embeddings.py
+"""
+Register an embedding version for a model and start (or resume) its re-embedding backfill.
+
+    python -m app.scripts.backfill_embeddings m-a-p/MERT-v1-95M --dim 768
+
+The backfill runs on the "backfill" Celery queue in checkpointed batches and switches
+similarity search to the new version once coverage reaches BACKFILL_ACTIVATE_COVERAGE.
+Re-running the command resumes from the stored checkpoint.
+"""
+import argparse
+from app.db import SessionLocal
+from app.embeddings import get_or_create_version, version_coverage, ensure_default_version
+from app.tasks import backfill_embeddings_task
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start or resume a re-embedding backfill")
+    parser.add_argument("model_name")
+    parser.add_argument("--dim", type=int, required=True, help="Embedding dimension produced by the model")
+    parser.add_argument("--restart", action="store_true", help="Reset the checkpoint and rescan the whole catalog")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        # the current model must be the active version before a new one is registered
+        ensure_default_version(db)
+        version = get_or_create_version(db, args.model_name, args.dim)
+        if version.is_active:
+            print(f"{version.model_name} ({version.dim}-d) is already the active version.")
+        else:
+            if args.restart:
+                version.backfill_cursor = 0
+                db.add(version)
+                db.commit()
+            backfill_embeddings_task.delay(version.id)
+            print(f"Queued backfill for version {version.id} ({version.model_name}, {version.dim}-d) "
+                  f"from track id {version.backfill_cursor}; coverage {version_coverage(db, version):.1%}.")
+            print(f"Progress: /api/task_status/backfill-{version.id}")
+    finally:
+        db.close()
@@ -0,0 +1,255 @@
+# app/scripts/embeddings_io.py
+"""
+Bulk export/import of track metadata + embeddings, so a new environment can be
+seeded without re-running MERT over the whole catalog.
+
+    python -m app.scripts.embeddings_io export data/embeddings
+    python -m app.scripts.embeddings_io import data/embeddings
+
+Export streams one embedding version (the active one by default) with a
+server-side cursor and writes one pair of files per chunk (tracks-NNNNN.parquet +
+embeddings-NNNNN.npy, row-aligned), so memory stays at one chunk regardless of
+catalog size. manifest.json records the model name and dimension.
+Import loads each chunk with binary COPY into a staging table, merges it into
+`tracks`/`track_embeddings` under the same version, and only then builds the
+version's vector index.
+"""
+import os
+import io
+import sys
+import json
+import glob
+import struct
+import argparse
+import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import select, func
+from app.db import engine, SessionLocal
+from app.models import Track, TrackEmbedding, EmbeddingVersion
+from app.embeddings import (
+    get_active_version, get_or_create_version, build_version_index, activate_version,
+    vector_index_name, version_coverage
+)
+
+METADATA_COLUMNS = ["spotify_track_id", "name", "artist", "preview_url"]
+
+# Postgres binary COPY framing: signature, flags, header extension length
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+PGCOPY_TRAILER = struct.pack("!h", -1)
+
+# Drop and rebuild even an active version's index when the import is this many times its current rows
+REINDEX_RATIO = 10
+
+
+def _chunk_paths(directory, index):
+    return (
+        os.path.join(directory, f"tracks-{index:05d}.parquet"),
+        os.path.join(directory, f"embeddings-{index:05d}.npy"),
+    )
+
+
+def export_embeddings(directory, chunk_size=10000, version_id=None):
+    """Stream one version's tracks + vectors out of Postgres into per-chunk Parquet/.npy files."""
+    db = SessionLocal()
+    try:
+        if version_id is None:
+            version = get_active_version(db)
+        else:
+            version = db.query(EmbeddingVersion).filter(EmbeddingVersion.id == version_id).first()
+        if version is None:
+            raise RuntimeError("No embedding version to export")
+        model_name, dim, version_id = version.model_name, version.dim, version.id
+    finally:
+        db.close()
+
+    os.makedirs(directory, exist_ok=True)
+    stmt = (
+        select(Track.spotify_track_id, Track.name, Track.artist, Track.preview_url, TrackEmbedding.embedding)
+        .join(TrackEmbedding, TrackEmbedding.track_id == Track.id)
+        .where(TrackEmbedding.version_id == version_id)
+        .order_by(Track.id)
+    )
+    chunks = 0
+    rows = 0
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(stmt)
+        for part in result.partitions():
+            meta_path, emb_path = _chunk_paths(directory, chunks)
+            table = pa.table({
+                "spotify_track_id": [row[0] for row in part],
+                "name": [row[1] for row in part],
+                "artist": [row[2] for row in part],
+                "preview_url": [row[3] for row in part],
+            })
+            pq.write_table(table, meta_path)
+            np.save(emb_path, np.asarray([row[4] for row in part], dtype=np.float32))
+            chunks += 1
+            rows += len(part)
+            print(f"Exported chunk {chunks} ({rows} tracks so far)")
+
+    manifest = {"model_name": model_name, "dim": dim, "chunks": chunks, "rows": rows}
+    with open(os.path.join(directory, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Exported {rows} tracks in {chunks} chunks to {directory}")
+    return manifest
+
+
+def _text_field(value):
+    if value is None:
+        return struct.pack("!i", -1)
+    data = value.encode("utf-8")
+    return struct.pack("!i", len(data)) + data
+
+
+def _vector_field(vec):
+    # pgvector binary format: int16 dim, int16 unused, big-endian float4 values
+    data = struct.pack("!hh", len(vec), 0) + vec.astype(">f4").tobytes()
+    return struct.pack("!i", len(data)) + data
+
+
+def _copy_buffer(metadata, embeddings):
+    """Encode one chunk as a binary COPY stream for the staging table."""
+    buf = io.BytesIO()
+    buf.write(PGCOPY_HEADER)
+    field_count = struct.pack("!h", len(METADATA_COLUMNS) + 1)
+    columns = [metadata[name] for name in METADATA_COLUMNS]
+    for i, vec in enumerate(embeddings):
+        buf.write(field_count)
+        for col in columns:
+            buf.write(_text_field(col[i]))
+        buf.write(_vector_field(vec))
+    buf.write(PGCOPY_TRAILER)
+    buf.seek(0)
+    return buf
+
+
+def import_embeddings(directory, build_index=True):
+    """Bulk-load exported chunks with binary COPY, then (re)build the version's vector index."""
+    meta_files = sorted(glob.glob(os.path.join(directory, "tracks-*.parquet")))
+    if not meta_files:
+        raise RuntimeError(f"No exported chunks found in {directory}")
+    with open(os.path.join(directory, "manifest.json"), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    dim = int(manifest["dim"])
+
+    db = SessionLocal()
+    try:
+        version = get_or_create_version(db, manifest["model_name"], dim)
+        version_id, index_name, is_active = version.id, vector_index_name(version), version.is_active
+        existing_rows = db.query(func.count(TrackEmbedding.track_id)).filter(
+            TrackEmbedding.version_id == version_id
+        ).scalar() or 0
+    finally:
+        db.close()
+
+    # Index maintenance per row is the slow part of a bulk load; rebuild once at the end.
+    # Keep the index only for an active version already serving a real catalog: one that is
+    # empty or small next to the import (e.g. just created by init_db) is searched just as
+    # well without it while the load runs.
+    reindex = not is_active or existing_rows * REINDEX_RATIO < int(manifest.get("rows") or 0)
+
+    started = time.time()
+    raw = engine.raw_connection()
+    try:
+        cur = raw.cursor()
+        # committed on its own so the ACCESS EXCLUSIVE lock isn't held across the whole load
+        if reindex:
+            cur.execute(f"DROP INDEX IF EXISTS {index_name}")
+            raw.commit()
+        cur.execute(f"""
+            CREATE TEMP TABLE tracks_import (
+                spotify_track_id VARCHAR NOT NULL,
+                name VARCHAR,
+                artist VARCHAR,
+                preview_url VARCHAR,
+                embedding vector({dim}) NOT NULL
+            ) ON COMMIT DROP
+        """)
+
+        rows = 0
+        for index, meta_path in enumerate(meta_files):
+            chunk = int(os.path.basename(meta_path)[len("tracks-"):-len(".parquet")])
+            _, emb_path = _chunk_paths(directory, chunk)
+            metadata = pq.read_table(meta_path).to_pydict()
+            embeddings = np.load(emb_path)
+            if embeddings.shape[0] != len(metadata["spotify_track_id"]):
+                raise RuntimeError(f"Row count mismatch in chunk {chunk}")
+            if embeddings.shape[1] != dim:
+                raise RuntimeError(f"Expected {dim}-d embeddings, got {embeddings.shape[1]}")
+            cur.copy_expert(
+                f"COPY tracks_import ({', '.join(METADATA_COLUMNS)}, embedding) FROM STDIN WITH (FORMAT binary)",
+                _copy_buffer(metadata, embeddings),
+            )
+            rows += embeddings.shape[0]
+            print(f"Copied chunk {index + 1}/{len(meta_files)} ({rows} tracks so far)")
+
+        # Tracks are shared across users, so merge on spotify_track_id rather than insert blindly
+        cur.execute("""
+            INSERT INTO tracks (spotify_track_id, name, artist, preview_url, encoded)
+            SELECT spotify_track_id, name, artist, preview_url, TRUE
+            FROM tracks_import
+            ON CONFLICT (spotify_track_id) DO UPDATE
+            SET preview_url = COALESCE(tracks.preview_url, EXCLUDED.preview_url),
+                encoded = TRUE
+        """)
+        cur.execute("""
+            INSERT INTO track_embeddings (track_id, version_id, embedding)
+            SELECT t.id, %s, i.embedding
+            FROM tracks_import i
+            JOIN tracks t ON t.spotify_track_id = i.spotify_track_id
+            ON CONFLICT (track_id, version_id) DO UPDATE
+            SET embedding = EXCLUDED.embedding
+        """, (version_id,))
+        raw.commit()
+        # refresh planner stats after the bulk merge
+        cur.execute("ANALYZE tracks")
+        cur.execute("ANALYZE track_embeddings")
+        raw.commit()
+        print(f"Loaded {rows} tracks in {time.time() - started:.1f}s")
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+
+    db = SessionLocal()
+    try:
+        version = db.query(EmbeddingVersion).filter(EmbeddingVersion.id == version_id).first()
+        # an active version always gets its index back, even with --skip-index
+        if build_index or (reindex and is_active):
+            started = time.time()
+            build_version_index(db, version)
+            print(f"Built {index_name} in {time.time() - started:.1f}s")
+        # A freshly seeded environment (no active vectors yet) serves the imported version straight away
+        active = get_active_version(db)
+        if active is None or version_coverage(db, active) == 0:
+            activate_version(db, version)
+            print(f"Activated {version.model_name} ({version.dim}-d)")
+    finally:
+        db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk export/import of track embeddings")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    exp = sub.add_parser("export", help="Stream tracks + embeddings to Parquet/.npy chunks")
+    exp.add_argument("directory")
+    exp.add_argument("--chunk-size", type=int, default=10000)
+    exp.add_argument("--version-id", type=int, default=None, help="Embedding version to export (default: active)")
+
+    imp = sub.add_parser("import", help="Bulk-load exported chunks with COPY")
+    imp.add_argument("directory")
+    imp.add_argument("--skip-index", action="store_true", help="Don't build the vector index after loading")
+
+    args = parser.parse_args(argv)
+    if args.command == "export":
+        export_embeddings(args.directory, chunk_size=args.chunk_size, version_id=args.version_id)
+    else:
+        import_embeddings(args.directory, build_index=not args.skip_index)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,7 @@
 # app/scripts/init_db.py
 from sqlalchemy import text
-from app.db import init_db, engine
+from app.db import init_db, engine, SessionLocal
+from app.embeddings import ensure_default_version
 
 if __name__ == "__main__":
     # Ensure pgvector extension exists before creating tables
@@ -14,3 +15,12 @@ if __name__ == "__main__":
 
     init_db()
     print("DB initialized.")
+
+    # One-time embedding-version migration (copies legacy vectors and builds the HNSW
+    # index, so it can take a while on a large catalog; kept out of app startup)
+    db = SessionLocal()
+    try:
+        ensure_default_version(db)
+        print("Ensured active embedding version.")
+    finally:
+        db.close()
@@ -18,9 +18,16 @@ document.addEventListener('DOMContentLoaded', function() {
   const playlistProgressText = document.getElementById('playlist-progress-text');
   const playlistProgressFill = document.getElementById('playlist-progress-fill');
   const spotifyFrame = document.getElementById('spotify-frame');
+  const recommendationsArea = document.getElementById('recommendations-area');
+  const recommendationsTitle = document.getElementById('recommendations-title');
+  const recommendationsList = document.getElementById('recommendations-list');
+  const savePlaylistBtn = document.getElementById('save-playlist-btn');
+  const tasteRecsBtn = document.getElementById('taste-recs-btn');
+  const libraryScope = document.getElementById('library-scope');
   
   let pollingInterval = null;
   let playlistPollingInterval = null;
+  let currentSeedTrack = null;
   
     async function loadEncoded() {
       try {
@@ -158,8 +165,55 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 
     async function selectSeedTrack(track) {
+      currentSeedTrack = track;
+      const fromLibrary = libraryScope?.checked;
+      // Playlist creation works off the global neighbors, so only offer it for those
+      savePlaylistBtn.style.display = fromLibrary ? 'none' : 'inline-block';
+      const scopeParams = fromLibrary ? `&scope=library&user_id=${parseInt(userId)}` : '';
+      // Neighbors come back inline; saving to Spotify is a separate, optional step
+      await loadRecommendations(`/api/recommendations/${track.id}?limit=10${scopeParams}`, `Similar to ${track.name} — ${track.artist}${fromLibrary ? ' (from your library)' : ''}`);
+    }
+
+    tasteRecsBtn?.addEventListener('click', async () => {
+      currentSeedTrack = null;
+      savePlaylistBtn.style.display = 'none';
+      await loadRecommendations(`/api/recommendations?user_id=${parseInt(userId)}&limit=10`, 'Picked for your taste');
+    });
+
+    async function loadRecommendations(url, title) {
+      recommendationsArea.style.display = 'block';
+      recommendationsTitle.textContent = title;
+      recommendationsList.innerHTML = '<li>Loading...</li>';
+      try {
+        const res = await fetch(url);
+        if (!res.ok) throw new Error(`HTTP error! status: ${res.status}`);
+        const data = await res.json();
+        recommendationsList.innerHTML = '';
+        data.tracks.forEach(t => {
+          const li = document.createElement('li');
+          li.textContent = `${t.name} — ${t.artist}`;
+          li.style.cursor = 'pointer';
+          li.onclick = () => {
+            spotifyFrame.src = `https://open.spotify.com/embed/track/${t.spotify_track_id}`;
+          };
+          recommendationsList.appendChild(li);
+        });
+        if (!data.tracks.length) {
+          recommendationsList.innerHTML = '<li>No similar tracks found</li>';
+        }
+      } catch (err) {
+        console.error(err);
+        recommendationsList.innerHTML = '<li>Failed to load recommendations</li>';
+      }
+    }
+
+    savePlaylistBtn?.addEventListener('click', () => {
+      if (currentSeedTrack) createPlaylist(currentSeedTrack);
+    });
+
+    async function createPlaylist(track) {
       try {
-        // Start playlist generation
+        // Start playlist generation (the task reuses the recommendations shown above)
         const res = await fetch(`/api/generate_playlist?user_id=${parseInt(userId)}&seed_track_id=${track.id}`, { method: 'POST' });
         if (!res.ok) throw new Error('Failed to start playlist task');
         const data = await res.json();
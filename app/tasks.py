@@ -6,24 +6,83 @@ import uuid
 from celery import shared_task, current_task
 from sqlalchemy.orm import Session
 from .db import SessionLocal
-from .models import User, Track, user_tracks
+from .models import User, Track, user_tracks, EmbeddingVersion, TrackEmbedding
 from .utils import download_preview_to_temp, resample_to_24k
 from .mert import MERTEmbedder
 from .celery_app import celery_app
 import redis
 import time
-from .recommenders import get_similar_tracks
+from .recommenders import get_similar_tracks, get_cached_recommendations
+from .previews import lookup_cached_previews, store_preview_results
+from .embeddings import (
+    MODEL_NAME, get_active_version, ensure_default_version,
+    save_track_embedding, version_coverage, build_version_index, activate_version,
+    update_taste_profile, sync_taste_profile
+)
 
 REDIS_URL = os.environ.get("REDIS_URL")
 r = redis.Redis.from_url(REDIS_URL, decode_responses=True)
 
-# instantiate model once per worker process
-EMBEDDER = None
-def get_embedder():
-    global EMBEDDER
-    if EMBEDDER is None:
-        EMBEDDER = MERTEmbedder()
-    return EMBEDDER
+# Re-embedding backfill tuning
+BACKFILL_BATCH_SIZE = int(os.environ.get("BACKFILL_BATCH_SIZE", "50"))
+BACKFILL_PAUSE_SECONDS = int(os.environ.get("BACKFILL_PAUSE_SECONDS", "5"))  # between batches
+BACKFILL_BACKOFF_SECONDS = int(os.environ.get("BACKFILL_BACKOFF_SECONDS", "60"))  # when live queue is busy
+BACKFILL_MAX_LIVE_QUEUE = int(os.environ.get("BACKFILL_MAX_LIVE_QUEUE", "0"))  # in-flight live syncs tolerated
+
+# Library syncs counted from enqueue until they finish (queued, prefetched or running);
+# the TTL self-heals the counter if a sync is lost without reaching its finally block
+LIVE_SYNCS_KEY = "live-library-syncs"
+LIVE_SYNCS_TTL = 2 * 3600
+BACKFILL_ACTIVATE_COVERAGE = float(os.environ.get("BACKFILL_ACTIVATE_COVERAGE", "0.98"))
+BACKFILL_LOCK_TTL = int(os.environ.get("BACKFILL_LOCK_TTL", "300"))  # refreshed per track
+BACKFILL_INDEX_LOCK_TTL = 6 * 3600  # HNSW build over the whole catalog
+
+# instantiate each model once per worker process
+EMBEDDERS = {}
+def get_embedder(model_name=MODEL_NAME):
+    if model_name not in EMBEDDERS:
+        EMBEDDERS[model_name] = MERTEmbedder(model_name=model_name)
+    return EMBEDDERS[model_name]
+
+def embed_preview(embedder, preview_url):
+    """Download a preview, resample to 24k and embed it. Returns None on failure."""
+    local_mp3 = None
+    try:
+        local_mp3 = download_preview_to_temp(preview_url)
+        waveform, sr = resample_to_24k(local_mp3)
+    except Exception as e:
+        print("Failed to download or resample:", e)
+        return None
+    finally:
+        # Clean up temporary file
+        if local_mp3 and os.path.exists(local_mp3):
+            try:
+                os.unlink(local_mp3)
+            except Exception as e:
+                print(f"Failed to clean up temporary file {local_mp3}: {e}")
+
+    try:
+        return embedder.embed_audio(waveform, sr)  # 1D numpy vector (normalized)
+    except Exception as e:
+        print("Embedding error:", e)
+        return None
+
+def mark_live_sync_queued():
+    """Call right before enqueueing update_user_library_task so the backfill yields to it."""
+    try:
+        pipe = r.pipeline()
+        pipe.incr(LIVE_SYNCS_KEY)
+        pipe.expire(LIVE_SYNCS_KEY, LIVE_SYNCS_TTL)
+        pipe.execute()
+    except Exception as e:
+        print(f"Error counting live sync: {e}")
+
+def _mark_live_sync_done():
+    try:
+        if r.decr(LIVE_SYNCS_KEY) < 0:
+            r.set(LIVE_SYNCS_KEY, 0, ex=LIVE_SYNCS_TTL)
+    except Exception as e:
+        print(f"Error counting live sync: {e}")
 
 def update_progress(task_id, message):
     """Helper function to publish progress and store latest message"""
@@ -37,9 +96,11 @@ def update_user_library_task(self, spotify_refresh_token, user_id):
     """
     1) Fetch user saved tracks via Spotipy (we'll use spotipy inside this task)
     2) Filter out tracks that are already encoded for this user (early exit if no new tracks)
-    3) Write data/tracks.json for remaining tracks
+    3) Look up preview URLs in the persistent preview cache; write data/tracks.json for the rest
     4) Call node/preview_finder.js as a subprocess (it reads data/tracks.json, writes data/preview_urls.json)
+       and cache its results (including "no preview") by spotify_track_id
     5) For each track with a preview_url, download, resample, get embedding, save embedding in Postgres
+       and fold it into the user's taste profile
     """
     from spotipy.oauth2 import SpotifyOAuth
     import spotipy
@@ -79,19 +140,32 @@ def update_user_library_task(self, spotify_refresh_token, user_id):
             if len(items) < limit:
                 break
 
-        # 2. Filter out tracks that are already encoded for this user
+        # New tracks are encoded into whichever version search currently serves
+        # (running the first-run migration if init_db hasn't been re-run since upgrading)
+        version = ensure_default_version(db)
+
+        # 2. Filter out tracks that are already encoded for this user.
+        # "Encoded" means having a vector in the active version: Track.encoded stays true for
+        # tracks only embedded by an older model, and those must be re-encoded.
+        saved_ids = [t["spotify_track_id"] for t in saved_tracks]
+        encoded_in_version = db.query(Track.spotify_track_id).join(
+            TrackEmbedding, TrackEmbedding.track_id == Track.id
+        ).filter(
+            TrackEmbedding.version_id == version.id,
+            Track.spotify_track_id.in_(saved_ids)
+        )
         # Get existing track IDs that are already linked to this user
-        existing_user_tracks = db.query(Track.spotify_track_id).join(user_tracks).filter(
-            user_tracks.c.user_id == user.id,
-            Track.encoded == True
+        existing_user_tracks = encoded_in_version.join(user_tracks, user_tracks.c.track_id == Track.id).filter(
+            user_tracks.c.user_id == user.id
         ).all()
         existing_user_track_ids = {t[0] for t in existing_user_tracks}
 
-        # Get all tracks that are already encoded globally
-        existing_encoded_tracks = db.query(Track.spotify_track_id).filter(
-            Track.encoded == True
-        ).all()
-        existing_encoded_ids = {t[0] for t in existing_encoded_tracks}
+        # Get all of the user's saved tracks that are already encoded globally
+        existing_encoded_ids = {t[0] for t in encoded_in_version.all()}
+
+        # Linked tracks that got their vector elsewhere never come back through this sync,
+        # so bring the taste profile up to date before deciding there is nothing to do
+        sync_taste_profile(db, user.id, version)
 
         # Find new tracks for this user (not already linked to user)
         new_tracks_for_user = [t for t in saved_tracks if t["spotify_track_id"] not in existing_user_track_ids]
@@ -113,11 +187,23 @@ def update_user_library_task(self, spotify_refresh_token, user_id):
                 tracks_to_process.append(track)
 
         # Link pre-encoded tracks to user immediately
+        linked_ids = []
         for track_data in tracks_to_link_only:
             track = db.query(Track).filter(Track.spotify_track_id == track_data["spotify_track_id"]).first()
-            if track and track not in user.tracks:
+            if track is None:
+                continue
+            if track not in user.tracks:
                 user.tracks.append(track)
                 db.commit()
+                linked_ids.append(track.id)
+
+        # Fold their vectors into the user's taste profile in one go
+        if linked_ids:
+            linked_vectors = db.query(TrackEmbedding.embedding).filter(
+                TrackEmbedding.version_id == version.id,
+                TrackEmbedding.track_id.in_(linked_ids)
+            ).all()
+            update_taste_profile(db, user.id, version, [list(v[0]) for v in linked_vectors])
 
         # Early exit if no tracks need processing
         if not tracks_to_process:
@@ -125,36 +211,47 @@ def update_user_library_task(self, spotify_refresh_token, user_id):
             update_progress(self.request.id, msg)
             return {"status": "finished", "processed": len(tracks_to_link_only), "total": len(new_tracks_for_user), "message": f"Linked {len(tracks_to_link_only)} pre-encoded tracks"}
 
-        # 3. save tracks.json for node script (only tracks that need processing)
-        os.makedirs("data", exist_ok=True)
-        tracks_json = []
-        for t in tracks_to_process:
-            tracks_json.append({"name": t["name"], "artist": t["artist"], "spotify_track_id": t["spotify_track_id"]})
-        with open("data/tracks.json", "w", encoding="utf-8") as f:
-            json.dump(tracks_json, f, indent=2)
-
-        # 4. Run node preview finder script (subprocess)
-        # It will read data/tracks.json and output data/preview_urls.json mapping "name - artist" -> preview_url
-        node_cmd = ["node", "preview_finder.js"]
-        env = os.environ.copy()
-        proc = subprocess.run(node_cmd, capture_output=True, text=True, env=env, cwd="node")
-        print(proc.stdout)
-        if proc.returncode != 0:
-            # log but proceed; preview script may fail on some tracks
-            print("Node preview_finder error:", proc.stderr)
-
-        preview_map = {}
-        preview_file = "data/preview_urls.json"
-        if os.path.exists(preview_file):
-            with open(preview_file, "r", encoding="utf-8") as f:
-                preview_map = json.load(f)
+        # 3. Check the persistent preview cache in bulk; only unresolved/expired tracks go to node
+        preview_map = lookup_cached_previews(db, [t["spotify_track_id"] for t in tracks_to_process])
+        tracks_to_resolve = [t for t in tracks_to_process if t["spotify_track_id"] not in preview_map]
+
+        if tracks_to_resolve:
+            # save tracks.json for node script (only tracks that need resolving)
+            os.makedirs("data", exist_ok=True)
+            tracks_json = []
+            for t in tracks_to_resolve:
+                tracks_json.append({"name": t["name"], "artist": t["artist"], "spotify_track_id": t["spotify_track_id"]})
+            with open("data/tracks.json", "w", encoding="utf-8") as f:
+                json.dump(tracks_json, f, indent=2)
+
+            # 4. Run node preview finder script (subprocess)
+            # It will read data/tracks.json and output data/preview_urls.json mapping spotify_track_id -> preview_url
+            preview_file = "data/preview_urls.json"
+            if os.path.exists(preview_file):
+                os.remove(preview_file)  # never pick up a previous run's output
+            node_cmd = ["node", "preview_finder.js"]
+            env = os.environ.copy()
+            proc = subprocess.run(node_cmd, capture_output=True, text=True, env=env, cwd="node")
+            print(proc.stdout)
+            if proc.returncode != 0:
+                # log but proceed; preview script may fail on some tracks
+                print("Node preview_finder error:", proc.stderr)
+
+            resolved = {}
+            if os.path.exists(preview_file):
+                with open(preview_file, "r", encoding="utf-8") as f:
+                    resolved = json.load(f)
+            # cache hits and misses alike, but only for tracks the resolver actually reported on
+            resolved = {t["spotify_track_id"]: resolved[t["spotify_track_id"]]
+                        for t in tracks_to_resolve if t["spotify_track_id"] in resolved}
+            store_preview_results(db, resolved)
+            preview_map.update(resolved)
 
         # 5. For each track that needs processing, handle it
         total = len(tracks_to_process)
         processed = 0
         for idx, t in enumerate(tracks_to_process):
-            key = f'{t["name"]} - {t["artist"]}'.strip()
-            preview_url = preview_map.get(key)
+            preview_url = preview_map.get(t["spotify_track_id"])
             # publish progress
             msg = {"status": "processing", "index": idx+1, "total": total, "track": t, "preview_url_present": bool(preview_url)}
             update_progress(self.request.id, msg)
@@ -182,42 +279,25 @@ def update_user_library_task(self, spotify_refresh_token, user_id):
                 db.add(track)
                 db.commit()
                 db.refresh(track)
+            elif track.preview_url != preview_url:
+                # Tracks first stored without a preview keep the one found later (the backfill re-reads it)
+                track.preview_url = preview_url
+                db.add(track)
+                db.commit()
 
             # Link track to user (if not already linked)
             if track not in user.tracks:
                 user.tracks.append(track)
                 db.commit()
 
-            # download, resample
-            local_mp3 = None
-            try:
-                local_mp3 = download_preview_to_temp(preview_url)
-                waveform, sr = resample_to_24k(local_mp3)
-            except Exception as e:
-                print("Failed to download or resample:", e)
-                continue
-            finally:
-                # Clean up temporary file
-                if local_mp3 and os.path.exists(local_mp3):
-                    try:
-                        os.unlink(local_mp3)
-                    except Exception as e:
-                        print(f"Failed to clean up temporary file {local_mp3}: {e}")
-
-            # embed
-            try:
-                embedder = get_embedder()
-                vec = embedder.embed_audio(waveform, sr)  # 1D numpy vector (normalized)
-            except Exception as e:
-                print("Embedding error:", e)
+            # download, resample, embed
+            vec = embed_preview(get_embedder(version.model_name), preview_url)
+            if vec is None:
                 continue
 
-            
-            # Update track with embedding
-            track.embedding = list(map(float, vec.tolist()))
-            track.encoded = True  # Mark track as encoded globally
-            db.add(track)
-            db.commit()
+            # Store embedding under the version it was produced by
+            save_track_embedding(db, track, version, vec.tolist())
+            update_taste_profile(db, user.id, version, [vec.tolist()])
 
             processed += 1
             # publish progress with track data for real-time updates
@@ -240,6 +320,7 @@ def update_user_library_task(self, spotify_refresh_token, user_id):
         return {"status": "finished", "processed": processed, "total": total}
     finally:
         db.close()
+        _mark_live_sync_done()
 
 
 def _spotify_client_from_refresh_token(refresh_token: str):
@@ -259,8 +340,8 @@ def _spotify_client_from_refresh_token(refresh_token: str):
 @shared_task(bind=True)
 def generate_playlist_task(self, spotify_refresh_token: str, user_id: int, seed_track_id: int):
     """
-    1) Validate seed track has embedding; error if not
-    2) Find top 10 similar tracks (encoded=True)
+    1) Reuse the seed's recommendations if /api/recommendations already computed them
+    2) Otherwise validate seed track has embedding (error if not) and find top 10 similar tracks
     3) Create a private playlist on the user's Spotify account
     4) Add similar tracks to the playlist
     5) Return playlist identifiers and embed URL
@@ -272,16 +353,23 @@ def generate_playlist_task(self, spotify_refresh_token: str, user_id: int, seed_
         if user is None:
             raise RuntimeError("User not found")
 
-        # Load seed track and verify embedding
+        # Load seed track; get_similar_tracks verifies it has an embedding in the active version
         seed = db.query(Track).filter(Track.id == seed_track_id).first()
-        emb = seed.embedding if seed is not None else None
-        if seed is None or emb is None or (hasattr(emb, "__len__") and len(emb) == 0):
-            msg = {"status": "failed", "message": f"No embedding found for track '{seed.name if seed else seed_track_id}'"}
+        if seed is None:
+            msg = {"status": "failed", "message": f"Track '{seed_track_id}' not found"}
             update_progress(self.request.id, msg)
-            raise RuntimeError(msg["message"])  # surfaces to frontend as FAILURE
+            raise RuntimeError(msg["message"])
 
         update_progress(self.request.id, {"status": "finding_similar", "message": "Finding similar tracks..."})
-        similar = get_similar_tracks(db, seed_track_id=seed_track_id, limit=10)
+        try:
+            version = get_active_version(db)
+            similar = get_cached_recommendations(r, version.id, seed_track_id, 10) if version else None
+            if similar is None:
+                similar = get_similar_tracks(db, seed_track_id=seed_track_id, limit=10, version=version)
+        except ValueError:
+            msg = {"status": "failed", "message": f"No embedding found for track '{seed.name}'"}
+            update_progress(self.request.id, msg)
+            raise RuntimeError(msg["message"])  # surfaces to frontend as FAILURE
 
         # Build URIs list
         uris = [f"spotify:track:{row['spotify_track_id']}" for row in similar]
@@ -323,3 +411,116 @@ def generate_playlist_task(self, spotify_refresh_token: str, user_id: int, seed_
         raise
     finally:
         db.close()
+
+
+def _live_encoding_backlog():
+    """
+    Number of live library syncs in flight. The broker queue length alone misses syncs a
+    worker has already prefetched or started, so the enqueue-to-finish counter is used too.
+    """
+    try:
+        return max(int(r.get(LIVE_SYNCS_KEY) or 0), r.llen("encoding"))
+    except Exception:
+        return 0
+
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def backfill_embeddings_task(self, version_id: int):
+    """
+    Re-encode the catalog into a (new) embedding version, one batch per task run.
+    1) Back off while live library syncs are queued so user-facing encoding isn't starved
+    2) Encode the next batch of tracks after the version's checkpoint cursor (keyset by tracks.id)
+    3) Advance and commit the cursor, then re-enqueue itself for the next batch
+    4) Once the catalog is exhausted and coverage >= BACKFILL_ACTIVATE_COVERAGE, build the
+       version's vector index and atomically switch search over to it
+    The cursor lives in Postgres and the task is acks_late + reject_on_worker_lost, so the
+    batch message of a crashed worker is redelivered and resumes from the last committed batch.
+    Progress is polled via /api/task_status/backfill-<version_id>.
+    """
+    lock_key = f"backfill-lock-{version_id}"
+    # Only one batch per version runs at a time. The lock holds the task id and a short TTL
+    # that is refreshed per track, so a dead holder frees it quickly. A redelivered message
+    # keeps its task id and may take over its own stale lock right away; any other holder
+    # is a live chain that re-enqueues itself, so duplicates just drop out.
+    if r.get(lock_key) == self.request.id:
+        r.set(lock_key, self.request.id, ex=BACKFILL_LOCK_TTL)
+    elif not r.set(lock_key, self.request.id, nx=True, ex=BACKFILL_LOCK_TTL):
+        return {"status": "skipped", "message": "Backfill already running"}
+
+    progress_id = f"backfill-{version_id}"
+    requeue_in = None
+    db: Session = SessionLocal()
+    try:
+        version = db.query(EmbeddingVersion).filter(EmbeddingVersion.id == version_id).first()
+        if version is None:
+            raise RuntimeError("Embedding version not found")
+        if version.is_active:
+            return {"status": "finished", "message": "Version already active"}
+
+        if _live_encoding_backlog() > BACKFILL_MAX_LIVE_QUEUE:
+            requeue_in = BACKFILL_BACKOFF_SECONDS
+            return {"status": "throttled", "cursor": version.backfill_cursor}
+
+        batch = db.query(Track).filter(
+            Track.id > version.backfill_cursor,
+            Track.encoded == True
+        ).order_by(Track.id).limit(BACKFILL_BATCH_SIZE).all()
+
+        if batch:
+            version.backfill_status = "running"
+            # skip tracks the live sync path (or an interrupted run) already encoded
+            done = {row[0] for row in db.query(TrackEmbedding.track_id).filter(
+                TrackEmbedding.version_id == version.id,
+                TrackEmbedding.track_id.in_([t.id for t in batch])
+            ).all()}
+            # rows stored before their preview was known fall back to the preview cache
+            cached_previews = lookup_cached_previews(
+                db, [t.spotify_track_id for t in batch if t.id not in done and not t.preview_url]
+            )
+            embedder = get_embedder(version.model_name)
+            encoded = 0
+            for track in batch:
+                if track.id in done:
+                    continue
+                r.expire(lock_key, BACKFILL_LOCK_TTL)
+                preview_url = track.preview_url or cached_previews.get(track.spotify_track_id)
+                if not preview_url:
+                    continue
+                vec = embed_preview(embedder, preview_url)
+                if vec is None:
+                    continue
+                save_track_embedding(db, track, version, vec.tolist())
+                encoded += 1
+
+            # checkpoint
+            version.backfill_cursor = batch[-1].id
+            db.add(version)
+            db.commit()
+            requeue_in = BACKFILL_PAUSE_SECONDS
+            msg = {"status": "processing", "cursor": version.backfill_cursor, "encoded": encoded}
+            update_progress(progress_id, msg)
+            return msg
+
+        coverage = version_coverage(db, version)
+        if coverage < BACKFILL_ACTIVATE_COVERAGE:
+            version.backfill_status = "incomplete"
+            db.add(version)
+            db.commit()
+            msg = {"status": "incomplete", "coverage": coverage,
+                   "message": f"Coverage {coverage:.1%} below activation threshold {BACKFILL_ACTIVATE_COVERAGE:.1%}"}
+            update_progress(progress_id, msg)
+            return msg
+
+        r.expire(lock_key, BACKFILL_INDEX_LOCK_TTL)
+        build_version_index(db, version)
+        activate_version(db, version)
+        msg = {"status": "finished", "coverage": coverage, "message": f"Activated {version.model_name} ({version.dim}-d)"}
+        update_progress(progress_id, msg)
+        return msg
+    finally:
+        db.close()
+        if r.get(lock_key) == self.request.id:
+            r.delete(lock_key)
+        # re-enqueue only after releasing the lock so the next batch can acquire it
+        if requeue_in is not None:
+            self.apply_async(args=[version_id], countdown=requeue_in)
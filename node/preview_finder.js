@@ -52,10 +52,12 @@ async function processTracks() {
       const name = track?.name || '';
       const artist = track?.artist || '';
       const key = `${name} - ${artist}`.trim();
+      // Results are keyed by Spotify track id so the worker can cache them reliably
+      const resultKey = track?.spotify_track_id || key;
       
       if (!name || !artist) {
         console.log(`⚠️  Skipping track ${processedCount}/${tracks.length}: Missing name or artist`);
-        results[key] = null;
+        results[resultKey] = null;
         continue;
       }
       
@@ -83,7 +85,7 @@ async function processTracks() {
           const previewUrls = song.previewUrls || [];
           const previewUrl = previewUrls.length > 0 ? previewUrls[0] : null;
           
-          results[key] = previewUrl;
+          results[resultKey] = previewUrl;
           
           if (previewUrl) {
             foundCount++;
@@ -96,16 +98,18 @@ async function processTracks() {
             console.log(`⚠️  No preview URL available for: ${key}`);
           }
         } else {
-          results[key] = null;
           console.log(`❌ No matches found for: ${key}`);
           if (result?.error) {
+            // Lookup failed (e.g. rate limited): leave it out so it isn't cached as "no preview"
             console.log(`   Error: ${result.error}`);
+          } else {
+            results[resultKey] = null;
           }
         }
       } catch (error) {
+        // Transient failure: omit the track so the worker retries it on the next sync
         console.error(`🔥 Error during search for ${key}:`, error.message);
         console.error(error.stack);
-        results[key] = null;
       }
       
       // Add a small delay between requests to avoid rate limiting